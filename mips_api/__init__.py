@@ -1,13 +1,32 @@
+import gzip
+import hashlib
 import json
 import logging
 import os
+import socket
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
 
 import backoff
 import boto3
 import requests
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoRegionError
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.connection import HTTPConnection
 from urllib3.exceptions import RequestError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 
@@ -16,18 +35,138 @@ _mips_url_coa_segments = "https://api.mip.com/api/coa/segments"
 _mips_url_coa_accounts = "https://api.mip.com/api/coa/segments/accounts"
 _mips_url_logout = "https://api.mip.com/api/security/logout"
 
+# Share one boto3 session between clients, and keep their connections
+# to AWS services alive between warm runs
+_boto_session = boto3.session.Session()
+_boto_config = Config(tcp_keepalive=True)
+
 # These are global so that they can be stubbed in test.
 # Because they are global their value will be retained
 # in the lambda environment and re-used on warm runs.
-ssm_client = None
-s3_client = None
+# They are created during lambda initialization when an AWS region is
+# configured, otherwise they are created on first use.
+try:
+    ssm_client = _boto_session.client("ssm", config=_boto_config)
+    s3_client = _boto_session.client("s3", config=_boto_config)
+except NoRegionError:
+    ssm_client = None
+    s3_client = None
+
+# Probe idle upstream connections with TCP keepalive, so that connections
+# dropped while the lambda is frozen between warm runs are detected
+_keepalive_options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    _keepalive_options += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+    ]
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTP adapter which enables TCP keepalive on its connections
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = (
+            HTTPConnection.default_socket_options + _keepalive_options
+        )
+        return super().init_poolmanager(*args, **kwargs)
+
+
+# Re-use connections to the upstream API within a run and between warm runs.
+# Retries are handled by the backoff decorators, not by the adapter.
+_http_session = requests.Session()
+_http_session.mount(
+    "https://",
+    _KeepAliveAdapter(pool_connections=2, pool_maxsize=4, max_retries=0),
+)
+
+# Threads for making independent upstream requests concurrently
+_executor = ThreadPoolExecutor(max_workers=2)
+
+# CloudFront will only wait a maximum of 60 seconds for a response from this
+# lambda, so upstream requests must finish within `_upstream_time_limit`
+# seconds. Logging out must finish by the "logout" deadline, and requests
+# made before logging out by the "request" deadline, which reserves
+# `_logout_max_time` seconds for logging out. No request attempt is started
+# unless it can finish before its deadline.
+_upstream_time_limit = 55
+_request_timeout = 4
+_logout_max_time = 28
+_logout_timeout = 6
+_deadlines = {}
+
+# Access tokens from sessions that failed to log out. Logging in again
+# before logging these out would lock us out of the upstream API, so logging
+# them out is retried on the next run, within the logout deadline, and that
+# run then skips logging in.
+_pending_logouts = []
+
+# The ID of the "Program" segment for each organization, with the time it
+# was requested. Segment IDs rarely change, so they are re-used on warm runs
+# for up to `_segment_ttl` seconds.
+_segment_ids = {}
+_segment_ttl = 86400
+
+# Configuration read from the environment and secure parameters read from
+# SSM are loaded on the first run and re-used on warm runs. Secrets are
+# refreshed after `_secrets_ttl` seconds in case they have been rotated.
+_config = None
+_secrets = None
+_secrets_time = 0.0
+_secrets_ttl = 900
+
+# The raw chart of accounts for each organization, with the time it was
+# collected. Warm runs re-use it for up to `ChartCacheSeconds` seconds
+# without contacting the upstream API.
+_charts = {}
+
+# Processed charts are re-used on warm runs, keyed on the options used to
+# process them, and discarded when a different raw chart of accounts is
+# processed. `_get_chart()` returns the same chart object until it collects
+# a new one, so charts are compared by identity rather than by content.
+# Every query string reaches this lambda, so only the most recently used
+# `_processed_charts_max` processed charts are kept.
+_processed_charts = OrderedDict()
+_processed_charts_max = 64
+_processed_source = None
+
+# The last known ETag and content of each S3 cache object, so that an
+# unchanged object doesn't need to be downloaded again on warm runs.
+_s3_cache_objects = {}
 
 
 def _get_os_var(varnam):
-    try:
-        return os.environ[varnam]
-    except KeyError as exc:
+    value = os.environ.get(varnam)
+    if value is None:
         raise Exception(f"The environment variable '{varnam}' must be set")
+    return value
+
+
+def _json_dumps(data, sort_keys=False):
+    """
+    Serialize data to a compact JSON string, optionally with sorted keys,
+    preferring orjson over the stdlib json module when it is available.
+    Both produce the same output for the same data.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else None
+        return orjson.dumps(data, option=option).decode()
+    return json.dumps(
+        data, separators=(",", ":"), sort_keys=sort_keys, ensure_ascii=False
+    )
+
+
+def _json_loads(data):
+    """
+    Deserialize a JSON string or bytes, preferring orjson over the stdlib
+    json module when it is available.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 def _parse_codes(codes):
@@ -37,23 +176,23 @@ def _parse_codes(codes):
     return data
 
 
-def _param_bool(params, param):
-    if params and param in params:
-        if params[param].lower() not in ["false", "no", "off"]:
-            return True
-    return False
-
-
-def _param_inactive_bool(params):
-    return not _param_bool(params, "show_inactive_codes")
+_false_values = frozenset(["false", "no", "off"])
 
 
-def _param_other_bool(params):
-    return _param_bool(params, "show_other_code")
+def _param_bool(params, param):
+    value = params.get(param) if params else None
+    if value is not None:
+        return value.lower() not in _false_values
+    return False
 
 
-def _param_no_program_bool(params):
-    return not _param_bool(params, "hide_no_program_code")
+# Boolean output options, with the query-string parameter each one is read
+# from and whether the option is the inverse of the parameter
+_bool_params = (
+    ("hide_inactive", "show_inactive_codes", True),
+    ("show_other", "show_other_code", False),
+    ("show_no_program", "hide_no_program_code", True),
+)
 
 
 def _param_limit_int(params):
@@ -73,128 +212,318 @@ def _param_priority_list(params):
     return None
 
 
+@dataclass(frozen=True, slots=True)
+class _QueryOptions:
+    """Output options parsed from query-string parameters"""
+
+    hide_inactive: bool
+    show_other: bool
+    show_no_program: bool
+    priority_codes: tuple | None
+    limit: int
+
+
+@lru_cache(maxsize=64)
+def _parse_params(param_items):
+    """
+    Parse query-string parameters into output options. Results are cached
+    on the raw parameters, since warm runs commonly see the same query
+    string repeatedly, and are immutable so they can't be altered.
+    """
+    params = dict(param_items)
+    priority_codes = _param_priority_list(params)
+
+    bool_options = {
+        option: _param_bool(params, param) != invert
+        for option, param, invert in _bool_params
+    }
+
+    return _QueryOptions(
+        **bool_options,
+        priority_codes=None if priority_codes is None else tuple(priority_codes),
+        limit=_param_limit_int(params),
+    )
+
+
+def _query_options(params):
+    """Get the parsed output options for a set of query-string parameters"""
+    param_items = tuple(sorted(params.items())) if params else ()
+    return _parse_params(param_items)
+
+
+def _load_config():
+    """Read lambda configuration from environment variables"""
+
+    return {
+        "mips_org": _get_os_var("MipsOrg"),
+        "ssm_path": _get_os_var("SsmPath"),
+        "s3_bucket": _get_os_var("CacheBucket"),
+        "s3_path": _get_os_var("CacheBucketPath"),
+        "code_other": _get_os_var("OtherCode"),
+        "code_no_program": _get_os_var("NoProgramCode"),
+        # map each API path to the function that builds its output
+        "api_routes": {
+            _get_os_var("ApiChartOfAccounts"): limit_chart,
+            _get_os_var("ApiValidTags"): list_tags,
+        },
+        "omit_codes": frozenset(_parse_codes(_get_os_var("CodesToOmit"))),
+        "chart_ttl": float(_get_os_var("ChartCacheSeconds")),
+    }
+
+
+def _get_config():
+    """
+    Environment variables can't change during the lifetime of a lambda
+    environment, so only read them once.
+    """
+    global _config
+    if _config is None:
+        _config = _load_config()
+    return _config
+
+
+def _get_secrets(ssm_path):
+    """
+    Collect secure parameters from SSM, re-using previously collected
+    values on warm runs until they are older than `_secrets_ttl` seconds.
+    """
+    global _secrets, _secrets_time
+
+    now = time.monotonic()
+    if _secrets is None or now - _secrets_time > _secrets_ttl:
+        _secrets = collect_secrets(ssm_path)
+        _secrets_time = now
+
+    return _secrets
+
+
+def _initialize():
+    """
+    Load configuration and secure parameters during lambda initialization,
+    so that the first run doesn't wait on SSM. Any errors are logged and
+    raised again when the first run loads them.
+    """
+    try:
+        _get_secrets(_get_config()["ssm_path"])
+    except Exception as exc:
+        LOG.info("Deferring configuration to the first run: %s", exc)
+
+
 def collect_secrets(ssm_path):
     """Collect secure parameters from SSM"""
 
     # create boto client
     global ssm_client
     if ssm_client is None:
-        ssm_client = boto3.client("ssm")
+        ssm_client = _boto_session.client("ssm", config=_boto_config)
 
     # object to return
     ssm_secrets = {}
 
-    # get secret parameters from ssm
-    params = ssm_client.get_parameters_by_path(
+    # strip leading path plus / char
+    strip_len = len(ssm_path) + 1
+
+    # get secret parameters from ssm, following pagination so that
+    # parameters aren't silently missed on a large hierarchy
+    paginator = ssm_client.get_paginator("get_parameters_by_path")
+    pages = paginator.paginate(
         Path=ssm_path,
         Recursive=True,
         WithDecryption=True,
     )
-    if "Parameters" in params:
+    for params in pages:
+        if "Parameters" not in params:
+            raise Exception(f"Invalid response from SSM client")
+
         for p in params["Parameters"]:
-            # strip leading path plus / char
-            if len(p["Name"]) > len(ssm_path):
-                name = p["Name"][len(ssm_path) + 1 :]
+            if len(p["Name"]) >= strip_len:
+                name = p["Name"][strip_len:]
             else:
                 name = p["Name"]
             ssm_secrets[name] = p["Value"]
-            LOG.info(f"Loaded secret: {name}")
-    else:
-        raise Exception(f"Invalid response from SSM client")
+            LOG.info("Loaded secret: %s", name)
 
-    for reqkey in ["user", "pass"]:
-        if reqkey not in ssm_secrets:
-            raise Exception(f"Missing required secure parameter: {reqkey}")
+    # report all missing parameters at once
+    missing = {"user", "pass"} - ssm_secrets.keys()
+    if missing:
+        missing_str = ", ".join(sorted(missing))
+        raise Exception(f"Missing required secure parameters: {missing_str}")
 
     return ssm_secrets
 
 
-@backoff.on_exception(backoff.expo, (RequestError, RequestException), max_time=11)
+def _attempt_time(timeout):
+    """
+    The longest time a request attempt may take. The timeout of a request
+    applies separately to connecting and to reading the response, so an
+    attempt may take twice its timeout. This assumes that the small responses
+    from the upstream API are read without long pauses between reads.
+    """
+    return 2 * timeout
+
+
+def _check_deadline(name, timeout):
+    """
+    Raise an exception instead of starting a request attempt that may not
+    finish before the named deadline. Backoff doesn't retry the exception.
+    """
+    deadline = _deadlines.get(name)
+    if deadline is not None:
+        if time.monotonic() + _attempt_time(timeout) > deadline:
+            raise TimeoutError(f"Not enough time left before the {name} deadline")
+
+
+def _request_max_time(max_time, timeout, name):
+    """
+    Build a callable for the `max_time` of a backoff decorator, which limits
+    retries to `max_time` seconds, or to the last time an attempt could start
+    and still finish before the named deadline, whichever is sooner.
+
+    Backoff may start one more attempt after `max_time`, so this only avoids
+    waiting for retries that can't happen; each attempt checks the deadline
+    itself with `_check_deadline()`.
+    """
+
+    def _max_time():
+        deadline = _deadlines.get(name)
+        if deadline is None:
+            return max_time
+
+        remaining = deadline - time.monotonic() - _attempt_time(timeout)
+        return max(0, min(max_time, remaining))
+
+    return _max_time
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (RequestError, RequestException),
+    max_time=_request_max_time(11, _request_timeout, "request"),
+)
 def _request_login(creds):
     """
     Wrap login request with backoff decorator, using exponential backoff
     and running for at most 11 seconds. With a connection timeout of 4
     seconds, this allows two attempts.
     """
-    timeout = 4
+    timeout = _request_timeout
+    _check_deadline("request", timeout)
     LOG.info("Logging in to upstream API")
 
-    login_response = requests.post(
+    # serialize the credentials here rather than with the stdlib encoder
+    # used by `requests` for its `json` argument
+    login_response = _http_session.post(
         _mips_url_login,
-        json=creds,
+        data=_json_dumps(creds).encode(),
+        headers={"Content-Type": "application/json"},
         timeout=timeout,
     )
     login_response.raise_for_status()
-    token = login_response.json()["AccessToken"]
+    token = _json_loads(login_response.content)["AccessToken"]
     return token
 
 
-@backoff.on_exception(backoff.expo, (RequestError, RequestException), max_time=11)
-def _request_program_segment(access_token):
+@backoff.on_exception(
+    backoff.expo,
+    (RequestError, RequestException),
+    max_time=_request_max_time(11, _request_timeout, "request"),
+)
+def _request_segments(access_token):
     """
     Wrap the request for chart segment IDs with backoff decorator, using
     exponential backoff and running for at most 11 seconds. With a
     connection timeout of 4 seconds, this allows two attempts.
-    Only return the ID of the "Program" segment needed for filtering.
+    Return a mapping of segment titles to segment IDs.
     """
-    timeout = 4
+    timeout = _request_timeout
+    _check_deadline("request", timeout)
     LOG.info("Getting chart segments")
 
     # get segments from api
-    segment_response = requests.get(
+    segment_response = _http_session.get(
         _mips_url_coa_segments,
         headers={"Authorization-Token": access_token},
         timeout=timeout,
     )
     segment_response.raise_for_status()
-    json_response = segment_response.json()
-    LOG.debug(f"Raw segment json: {json_response}")
+    json_response = _json_loads(segment_response.content)
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Raw segment json: %s", json_response)
+
+    return {
+        segment["TITLE"]: segment["COA_SEGID"] for segment in json_response["COA_SEGID"]
+    }
+
 
-    # get the segment ID for the "Program" segment
-    seg_id = None
-    for segment in json_response["COA_SEGID"]:
-        if segment["TITLE"] == "Program":
-            seg_id = segment["COA_SEGID"]
-            break
+def _request_program_segment(access_token):
+    """
+    Only return the ID of the "Program" segment needed for filtering.
+    """
 
-    if seg_id is None:
+    segments = _request_segments(access_token)
+    if "Program" not in segments:
         raise ValueError("Program segment not found")
 
-    return seg_id
+    return segments["Program"]
 
 
-@backoff.on_exception(backoff.expo, (RequestError, RequestException), max_time=11)
-def _request_accounts(access_token, program_id):
+@backoff.on_exception(
+    backoff.expo,
+    (RequestError, RequestException),
+    max_time=_request_max_time(11, _request_timeout, "request"),
+)
+def _request_accounts(access_token):
     """
     Wrap the request for chart of accounts with backoff decorator, using
     exponential backoff and running for at most 11 seconds. With a
     connection timeout of 4 seconds, this allows two attempts.
-    Only return results for active accounts in the program segment.
+    Return the accounts in all segments grouped by segment ID, to be
+    filtered once the ID of the "Program" segment is known.
     """
-    timeout = 4
+    timeout = _request_timeout
+    _check_deadline("request", timeout)
     LOG.info("Getting chart of accounts")
 
     # get segments from api
-    account_response = requests.get(
+    account_response = _http_session.get(
         _mips_url_coa_accounts,
         headers={"Authorization-Token": access_token},
         timeout=timeout,
     )
     account_response.raise_for_status()
-    json_response = account_response.json()
-    LOG.debug(f"Raw account json: {json_response}")
+    json_response = _json_loads(account_response.content)
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Raw account json: %s", json_response)
 
-    accounts = {}
+    # group accounts by segment in a single pass
+    segment_accounts = {}
     for account in json_response["COA_SEGID"]:
-        # require "Program" segment and "A" status
-        if account["COA_SEGID"] == program_id and account["COA_STATUS"] == "A":
-            accounts[account["COA_CODE"]] = account["COA_TITLE"]
+        segment_accounts.setdefault(account["COA_SEGID"], []).append(account)
+
+    return segment_accounts
+
 
-    LOG.info(f"Chart of accounts: {accounts}")
+def _filter_accounts(segment_accounts, program_id):
+    """
+    Only return results for active accounts in the program segment.
+    """
+
+    # require "Program" segment and "A" status
+    accounts = {
+        account["COA_CODE"]: account["COA_TITLE"]
+        for account in segment_accounts.get(program_id, [])
+        if account["COA_STATUS"] == "A"
+    }
+
+    LOG.info("Chart of accounts: %s", accounts)
     return accounts
 
 
-@backoff.on_exception(backoff.fibo, (RequestError, RequestException), max_time=28)
+@backoff.on_exception(
+    backoff.fibo,
+    (RequestError, RequestException),
+    max_time=_request_max_time(_logout_max_time, _logout_timeout, "logout"),
+)
 def _request_logout(access_token):
     """
     Wrap logout request with backoff decorator, using fibonacci backoff
@@ -204,25 +533,38 @@ def _request_logout(access_token):
     Prioritize spending time logging out over the other requests because
     failing to log out after successfully logging in will lock us out of
     the API; but CloudFront will only wait a maximum of 60 seconds for a
-    response from this lambda.
+    response from this lambda, so no attempt is started unless it can finish
+    before the logout deadline.
     """
-    timeout = 6
+    timeout = _logout_timeout
+    _check_deadline("logout", timeout)
     LOG.info("Logging out of upstream API")
 
-    requests.post(
+    _http_session.post(
         _mips_url_logout,
         headers={"Authorization-Token": access_token},
         timeout=timeout,
     )
 
 
-def _upstream_requests(org_name, secrets):
+def _retry_pending_logout():
     """
-    Log into MIPS, get the chart of accounts, and log out
+    Log out of a session that failed to log out on a previous run, raising
+    an exception if it still can't be logged out. Only one logout is retried
+    per run, since a logout may take all of the time available to a run.
     """
 
-    mips_dict = {}
-    access_token = None
+    LOG.info("Retrying a previously failed logout")
+    _request_logout(_pending_logouts[0])
+    _pending_logouts.pop(0)
+
+
+@contextmanager
+def _upstream_session(org_name, secrets):
+    """
+    Log into MIPS and provide the access token, then always log out when
+    done, so that several requests can share a single login.
+    """
 
     mips_creds = {
         "username": secrets["user"],
@@ -230,53 +572,166 @@ def _upstream_requests(org_name, secrets):
         "org": org_name,
     }
 
+    # get mips access token
+    access_token = _request_login(mips_creds)
+
     try:
-        # get mips access token
-        access_token = _request_login(mips_creds)
+        yield access_token
+
+    finally:
+        # It's important to logout. Logging in a second time without
+        # logging out will lock us out of the upstream API
+        try:
+            _request_logout(access_token)
+        except Exception as exc:
+            LOG.exception("Error logging out")
+            _pending_logouts.append(access_token)
+
+
+def _request_chart(access_token, org_name):
+    """
+    Get the chart of accounts for the "Program" segment, re-using the
+    segment ID from a previous run if it's still known to be valid.
+    """
 
-        # get the chart segments
-        program_id = _request_program_segment(access_token)
+    program_id = None
+    if org_name in _segment_ids:
+        program_id, requested = _segment_ids[org_name]
+        if time.monotonic() - requested > _segment_ttl:
+            program_id = None
+
+    if program_id is not None:
+        segment_accounts = _request_accounts(access_token)
+
+        # the segment ID may have changed if no accounts are found for it
+        if program_id not in segment_accounts:
+            LOG.info("No accounts found for previous segment ID")
+            program_id = _request_program_segment(access_token)
+            _segment_ids[org_name] = (program_id, time.monotonic())
+
+    else:
+        # get the chart segments and the chart of accounts concurrently,
+        # since both requests only need the access token. Wait for both
+        # to finish so that we don't log out with a request in flight.
+        segment_future = _executor.submit(_request_program_segment, access_token)
+        account_future = _executor.submit(_request_accounts, access_token)
+        wait([segment_future, account_future])
+
+        program_id = segment_future.result()
+        segment_accounts = account_future.result()
+        _segment_ids[org_name] = (program_id, time.monotonic())
+
+    return _filter_accounts(segment_accounts, program_id)
+
+
+def _upstream_requests(org_name, secrets):
+    """
+    Log into MIPS, get the chart of accounts, and log out
+    """
 
-        # get the chart of accounts
-        mips_dict = _request_accounts(access_token, program_id)
+    # leave enough time to log out before CloudFront stops waiting
+    _deadlines["logout"] = time.monotonic() + _upstream_time_limit
+    _deadlines["request"] = _deadlines["logout"] - _logout_max_time
+
+    # Retrying a failed logout may take as long as logging out after a
+    # login, so don't log in again on the same run. Rely on the S3 cache.
+    # The retry is bounded by the logout deadline, and the token stays
+    # queued if it times out.
+    if _pending_logouts:
+        try:
+            _retry_pending_logout()
+        except Exception as exc:
+            LOG.exception("Error retrying logout")
+        LOG.info("Skipping upstream requests after retrying a logout")
+        return {}
+
+    mips_dict = {}
+
+    try:
+        with _upstream_session(org_name, secrets) as access_token:
+            mips_dict = _request_chart(access_token, org_name)
 
     except Exception as exc:
         LOG.exception("Error interacting with upstream API")
 
-    finally:
-        # It's important to logout. Logging in a second time without
-        # logging out will lock us out of the upstream API
-        if access_token is not None:
-            try:
-                _request_logout(access_token)
-            except Exception as exc:
-                LOG.exception("Error logging out")
-
     return mips_dict
 
 
 def _s3_cache_read(bucket, path):
     """
-    Read MIP response from S3 cache object
+    Read MIP response from S3 cache object, making the request conditional
+    on the object having changed since it was last read or written.
     """
     global s3_client
     if s3_client is None:
-        s3_client = boto3.client("s3")
+        s3_client = _boto_session.client("s3", config=_boto_config)
 
-    data = s3_client.get_object(Bucket=bucket, Key=path)
-    return json.loads(data["Body"].read())
+    cache_key = (bucket, path)
+    request = {"Bucket": bucket, "Key": path}
+    if cache_key in _s3_cache_objects:
+        request["IfNoneMatch"] = _s3_cache_objects[cache_key][0]
 
+    try:
+        data = s3_client.get_object(**request)
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] == "304":
+            LOG.debug("S3 cache object not modified")
+            return _s3_cache_objects[cache_key][1]
+        raise
+
+    body = data["Body"].read()
+    if data.get("ContentEncoding") == "gzip":
+        body = gzip.decompress(body)
+
+    cache_data = _json_loads(body)
+    if "ETag" in data:
+        _s3_cache_objects[cache_key] = (data["ETag"], cache_data)
+    return cache_data
 
-def _s3_cache_write(data, bucket, path):
+
+def _s3_cache_body(data):
     """
-    Write MIP response to S3 cache object
+    Serialize MIP response for the S3 cache object, and return it along with
+    its SHA-256 digest. Keys are sorted so that the digest doesn't depend on
+    the order of the upstream response.
+    """
+    body = _json_dumps(data, sort_keys=True).encode()
+    return body, hashlib.sha256(body).hexdigest()
+
+
+def _s3_cache_digest(bucket, path):
+    """
+    Read the SHA-256 digest stored with the S3 cache object, without
+    downloading the object itself.
     """
     global s3_client
     if s3_client is None:
-        s3_client = boto3.client("s3")
+        s3_client = _boto_session.client("s3", config=_boto_config)
 
-    body = json.dumps(data)
-    s3_client.put_object(Bucket=bucket, Key=path, Body=body)
+    head = s3_client.head_object(Bucket=bucket, Key=path)
+    return head.get("Metadata", {}).get("sha256")
+
+
+def _s3_cache_write(data, body, digest, bucket, path):
+    """
+    Write MIP response to S3 cache object, compressed with gzip, storing the
+    SHA-256 digest of the uncompressed object as metadata. The body and
+    digest are provided by `_s3_cache_body()`.
+    """
+    global s3_client
+    if s3_client is None:
+        s3_client = _boto_session.client("s3", config=_boto_config)
+
+    response = s3_client.put_object(
+        Bucket=bucket,
+        Key=path,
+        Body=gzip.compress(body, compresslevel=3, mtime=0),
+        ContentEncoding="gzip",
+        ContentType="application/json",
+        Metadata={"sha256": digest},
+    )
+    if "ETag" in response:
+        _s3_cache_objects[(bucket, path)] = (response["ETag"], data)
 
 
 def chart_cache(org_name, secrets, bucket, path):
@@ -290,43 +745,52 @@ def chart_cache(org_name, secrets, bucket, path):
 
     The S3 bucket has versioning enabled for disaster recovery, but this means
     that every PUT request will create a new S3 object. In order to minimize
-    the number of objects in the bucket, read the cache value on every run and
-    only update the S3 object if it changes.
+    the number of objects in the bucket, compare the digest of the upstream
+    response to the digest stored with the cache object on every run and
+    only update the S3 object if it changes. The cache object itself is only
+    downloaded when the upstream API fails.
     """
 
     coa_dict = None
-    cache_dict = None
 
     # get the upstream API response
     LOG.info("Read chart of accounts from upstream API")
     upstream_dict = _upstream_requests(org_name, secrets)
-    LOG.debug(f"Upstream API response: {upstream_dict}")
-
-    # always read cached value
-    LOG.info("Read cached chart of accounts from S3")
-    try:
-        cache_dict = _s3_cache_read(bucket, path)
-        LOG.debug(f"Cached API response: {cache_dict}")
-    except Exception as exc:
-        LOG.exception("S3 read failure")
+    LOG.debug("Upstream API response: %s", upstream_dict)
 
     if upstream_dict:
         # if we received a non-empty response from the upstream API, compare it
         # to our cached response and update the S3 write-through cache if needed
-        if upstream_dict == cache_dict:
+        upstream_body, upstream_digest = _s3_cache_body(upstream_dict)
+
+        cache_digest = None
+        LOG.info("Read cached chart of accounts digest from S3")
+        try:
+            cache_digest = _s3_cache_digest(bucket, path)
+        except Exception as exc:
+            LOG.exception("S3 read failure")
+
+        if upstream_digest == cache_digest:
             LOG.debug("No change in chart of accounts")
         else:
             # store write-through cache
             LOG.info("Write updated chart of accounts to S3")
             try:
-                _s3_cache_write(upstream_dict, bucket, path)
+                _s3_cache_write(
+                    upstream_dict, upstream_body, upstream_digest, bucket, path
+                )
             except Exception as exc:
                 LOG.exception("S3 write failure")
         coa_dict = upstream_dict
     else:
         # no response (or an empty response) from the upstream API,
         # rely on our response cached in S3.
-        coa_dict = cache_dict
+        LOG.info("Read cached chart of accounts from S3")
+        try:
+            coa_dict = _s3_cache_read(bucket, path)
+            LOG.debug("Cached API response: %s", coa_dict)
+        except Exception as exc:
+            LOG.exception("S3 read failure")
 
     if not coa_dict:
         # make sure we don't return an empty value
@@ -335,7 +799,67 @@ def chart_cache(org_name, secrets, bucket, path):
     return coa_dict
 
 
+def _get_chart(config):
+    """
+    Get the raw chart of accounts, re-using the chart collected by a previous
+    run until it is older than the configured TTL.
+    """
+
+    org_name = config["mips_org"]
+    now = time.monotonic()
+    if org_name in _charts:
+        chart, collected = _charts[org_name]
+        if now - collected < config["chart_ttl"]:
+            LOG.info("Re-using chart of accounts from a previous run")
+            return chart
+
+    # get secure parameters
+    ssm_secrets = _get_secrets(config["ssm_path"])
+
+    # get chart of accounts from mips
+    chart = chart_cache(org_name, ssm_secrets, config["s3_bucket"], config["s3_path"])
+    _charts[org_name] = (chart, now)
+    return chart
+
+
 def process_chart(params, chart_dict, omit_list, other, no_program):
+    """
+    Process chart of accounts, re-using the output from a previous run
+    with the same chart of accounts object and processing options. The
+    chart of accounts must not be modified after it is first processed.
+    """
+    global _processed_source
+
+    if chart_dict is not _processed_source:
+        _processed_charts.clear()
+        _processed_source = chart_dict
+
+    options = _query_options(params)
+    # the output limit is applied after processing, so it isn't part of the key
+    key = (
+        options.hide_inactive,
+        options.show_other,
+        options.show_no_program,
+        options.priority_codes,
+        frozenset(omit_list),
+        other,
+        no_program,
+    )
+
+    if key not in _processed_charts:
+        _processed_charts[key] = _process_chart(
+            options, chart_dict, omit_list, other, no_program
+        )
+        if len(_processed_charts) > _processed_charts_max:
+            _processed_charts.popitem(last=False)
+    else:
+        LOG.debug("Re-using processed chart of accounts")
+        _processed_charts.move_to_end(key)
+
+    return _processed_charts[key]
+
+
+def _process_chart(options, chart_dict, omit_list, other, no_program):
     """
     Process chart of accounts to remove unneeded programs,
     and inject some extra (meta) programs.
@@ -347,19 +871,20 @@ def process_chart(params, chart_dict, omit_list, other, no_program):
 
     # deduplicate on shortened numeric codes
     # pre-populate with codes to omit to short-circuit their processing
-    found_codes = []
-    found_codes.extend(omit_list)
+    found_codes = set(omit_list)
 
-    # output object
-    out_chart = {}
+    # output items, assembled into a dictionary after processing
+    meta_items = []
+    priority_items = []
+    chart_items = []
 
     # whether to filter out inactive codes
     code_len = 5
-    if _param_inactive_bool(params):
+    if options.hide_inactive:
         code_len = 6
 
     # optionally move this list of codes to the top of the output
-    priority_codes = _param_priority_list(params)
+    priority_codes = options.priority_codes
 
     # add short codes
     for code, name in chart_dict.items():
@@ -367,40 +892,29 @@ def process_chart(params, chart_dict, omit_list, other, no_program):
             short = code[:6]  # ignore the last two digits on active codes
 
             if short in found_codes:
-                LOG.info(f"Code {short} has already been processed")
+                LOG.info("Code %s has already been processed", short)
                 continue
 
-            if priority_codes is not None:
-                if short in priority_codes:
-                    # Since Python 3.7, python dictionaries preserve insertion
-                    # order, so to prepend an item to the top of the dictionary,
-                    # we create a new dictionary inserting the target code first,
-                    # then add the previous output, and finally save the new
-                    # dictionary as our output dictionary.
-                    new_chart = {short: name}
-                    new_chart.update(out_chart)
-                    out_chart = new_chart
-                    found_codes.append(short)
-                else:
-                    out_chart[short] = name
-                    found_codes.append(short)
+            found_codes.add(short)
+            if priority_codes is not None and short in priority_codes:
+                priority_items.append((short, name))
             else:
-                out_chart[short] = name
-                found_codes.append(short)
-
-    # inject "other" code
-    if _param_other_bool(params):
-        new_chart = {other: "Other"}
-        new_chart.update(out_chart)
-        out_chart = new_chart
+                chart_items.append((short, name))
 
     # inject "no program" code
-    if _param_no_program_bool(params):
-        new_chart = {no_program: "No Program"}
-        new_chart.update(out_chart)
-        out_chart = new_chart
+    if options.show_no_program:
+        meta_items.append((no_program, "No Program"))
 
-    return out_chart
+    # inject "other" code
+    if options.show_other:
+        meta_items.append((other, "Other"))
+
+    # Since Python 3.7, python dictionaries preserve insertion order, so
+    # build the output dictionary in a single pass with the meta codes at
+    # the top, followed by priority codes (most recently found first), and
+    # then the remaining codes in their original order.
+    priority_items.reverse()
+    return dict(meta_items + priority_items + chart_items)
 
 
 def limit_chart(params, mips_dict):
@@ -409,10 +923,10 @@ def limit_chart(params, mips_dict):
     """
 
     # if a 'limit' query-string parameter is defined, "slice" the dictionary
-    limit = _param_limit_int(params)
+    limit = _query_options(params).limit
     if limit > 0:
-        # https://stackoverflow.com/a/66535220/1742875
-        _mips_dict = dict(list(mips_dict.items())[:limit])
+        # only iterate over the items being kept
+        _mips_dict = dict(islice(mips_dict.items(), limit))
         return _mips_dict
 
     return mips_dict
@@ -428,19 +942,16 @@ def list_tags(params, chart_dict):
         A list of strings.
     """
 
-    tags = []
-
-    # build tags from chart of accounts
-    for code, name in chart_dict.items():
-        tag = f"{name} / {code}"
-        tags.append(tag)
+    items = chart_dict.items()
 
-    limit = _param_limit_int(params)
+    # only build as many tags as will be returned
+    limit = _query_options(params).limit
     if limit > 0:
-        LOG.info(f"limiting output to {limit} values")
-        return tags[0:limit]
-    else:
-        return tags
+        LOG.info("limiting output to %s values", limit)
+        items = islice(items, limit)
+
+    # build tags from chart of accounts
+    return [f"{name} / {code}" for code, name in items]
 
 
 def lambda_handler(event, context):
@@ -469,63 +980,50 @@ def lambda_handler(event, context):
     def _build_return(code, body):
         return {
             "statusCode": code,
-            "body": json.dumps(body, indent=2),
+            "body": _json_dumps(body),
         }
 
     try:
         # collect environment variables
-        mips_org = _get_os_var("MipsOrg")
-        ssm_path = _get_os_var("SsmPath")
-        s3_bucket = _get_os_var("CacheBucket")
-        s3_path = _get_os_var("CacheBucketPath")
-
-        code_other = _get_os_var("OtherCode")
-        code_no_program = _get_os_var("NoProgramCode")
-
-        api_routes = {}
-        api_routes["ApiChartOfAccounts"] = _get_os_var("ApiChartOfAccounts")
-        api_routes["ApiValidTags"] = _get_os_var("ApiValidTags")
-
-        _to_omit = _get_os_var("CodesToOmit")
-        omit_codes_list = _parse_codes(_to_omit)
-
-        # get secure parameters
-        ssm_secrets = collect_secrets(ssm_path)
-
-        # get chart of accounts from mips
-        raw_chart = chart_cache(mips_org, ssm_secrets, s3_bucket, s3_path)
-        LOG.debug(f"Raw chart data: {raw_chart}")
+        config = _get_config()
+        api_routes = config["api_routes"]
 
         # collect query-string parameters
         params = {}
         if "queryStringParameters" in event:
             params = event["queryStringParameters"]
-            LOG.debug(f"Query-string parameters: {params}")
-
-        # parse the path and return appropriate data
-        if "path" in event:
-            event_path = event["path"]
+            LOG.debug("Query-string parameters: %s", params)
 
-            # always process the chart of accounts
-            mips_chart = process_chart(
-                params, raw_chart, omit_codes_list, code_other, code_no_program
+        # parse the path before doing any work for it
+        if "path" not in event:
+            return _build_return(
+                400, {"error": f"Invalid event: No path found: {event}"}
             )
 
-            if event_path == api_routes["ApiChartOfAccounts"]:
-                # conditionally limit the size of the output
-                _mips_chart = limit_chart(params, mips_chart)
-                return _build_return(200, _mips_chart)
+        build_output = api_routes.get(event["path"])
+        if build_output is None:
+            return _build_return(404, {"error": "Invalid request path"})
 
-            elif event_path == api_routes["ApiValidTags"]:
-                # build a list of strings from the processed dictionary
-                valid_tags = list_tags(params, mips_chart)
-                return _build_return(200, valid_tags)
+        # get chart of accounts from mips, or from a previous run
+        raw_chart = _get_chart(config)
+        LOG.debug("Raw chart data: %s", raw_chart)
 
-            else:
-                return _build_return(404, {"error": "Invalid request path"})
+        # process the chart of accounts, re-using output from a previous run
+        mips_chart = process_chart(
+            params,
+            raw_chart,
+            config["omit_codes"],
+            config["code_other"],
+            config["code_no_program"],
+        )
 
-        return _build_return(400, {"error": f"Invalid event: No path found: {event}"})
+        # either limit the size of the chart, or build a list of tags
+        # straight from the processed dictionary
+        return _build_return(200, build_output(params, mips_chart))
 
     except Exception as exc:
         LOG.exception(exc)
         return _build_return(500, {"error": str(exc)})
+
+
+_initialize()
@@ -1,9 +1,12 @@
+import gzip
 import io
 
 import mips_api
 
 import json
 import os
+import time
+from collections import OrderedDict
 
 import boto3
 import pytest
@@ -191,6 +194,14 @@ expected_mips_dict_processed_priority_codes = {
     "990300": "Platform Infrastructure",
 }
 
+expected_mips_dict_processed_priority_codes_multi = {
+    "000000": "No Program",
+    "54321": "Inactive",
+    "234567": "Other Program",
+    "123456": "Program Part A",
+    "990300": "Platform Infrastructure",
+}
+
 # expected tag list
 expected_tag_list = [
     "No Program / 000000",
@@ -210,6 +221,7 @@ mock_foo_param = {"foo": "bar"}
 mock_limit_param = {"limit": "2"}
 mock_other_param = {"show_other_code": "true"}
 mock_priority_param = {"priority_codes": "54321"}
+mock_priority_multi_param = {"priority_codes": "234567,54321"}
 mock_inactive_param = {"show_inactive_codes": "true"}
 mock_no_program_param = {"hide_no_program_code": "true"}
 
@@ -305,6 +317,26 @@ def test_secrets(mocker):
         assert secrets == mock_secrets
 
 
+def test_secrets_paginated(mocker):
+    """Test getting secret parameters from multiple pages of SSM results"""
+    # stub ssm client
+    mocker.patch.dict(os.environ, {"AWS_DEFAULT_REGION": "test"})
+    ssm = boto3.client("ssm")
+    mips_api.ssm_client = ssm
+    with Stubber(ssm) as _stub:
+        # split mock parameters across two pages
+        params = mock_ssm_params["Parameters"]
+        _stub.add_response(
+            "get_parameters_by_path",
+            {"Parameters": params[:1], "NextToken": "next"},
+        )
+        _stub.add_response("get_parameters_by_path", {"Parameters": params[1:]})
+
+        # assert secrets were collected from both pages
+        secrets = mips_api.collect_secrets(ssm_path)
+        assert secrets == mock_secrets
+
+
 def test_no_secrets(mocker):
     """Test failure getting secret parameters from SSM"""
     # stub ssm client
@@ -337,16 +369,59 @@ def test_bad_secrets(mocker):
             secrets = mips_api.collect_secrets(ssm_path)
 
 
+def test_secrets_cache(mocker):
+    """Test re-using secret parameters on warm runs"""
+    mocker.patch("mips_api._secrets", None)
+    collect_mock = mocker.patch(
+        "mips_api.collect_secrets", autospec=True, return_value=mock_secrets
+    )
+
+    # assert secrets are only collected once
+    assert mips_api._get_secrets(ssm_path) == mock_secrets
+    assert mips_api._get_secrets(ssm_path) == mock_secrets
+    assert collect_mock.call_count == 1
+
+    # assert expired secrets are collected again
+    mocker.patch("mips_api._secrets_time", 0.0)
+    mocker.patch("mips_api._secrets_ttl", -1)
+    assert mips_api._get_secrets(ssm_path) == mock_secrets
+    assert collect_mock.call_count == 2
+
+
+def test_initialize(mocker):
+    """Test loading secret parameters during lambda initialization"""
+    mocker.patch("mips_api._secrets", None)
+    collect_mock = mocker.patch(
+        "mips_api.collect_secrets", autospec=True, return_value=mock_secrets
+    )
+
+    # assert configuration errors are deferred to the first run
+    mocker.patch("mips_api._config", None)
+    mocker.patch.dict(os.environ, clear=True)
+    mips_api._initialize()
+    assert mips_api._config is None
+    assert collect_mock.call_count == 0
+
+    # assert secrets are collected when configuration is available
+    mocker.patch("mips_api._config", {"ssm_path": ssm_path})
+    mips_api._initialize()
+    assert mips_api._secrets == mock_secrets
+    collect_mock.assert_called_once_with(ssm_path)
+
+
 def test_upstream(mocker, requests_mock):
     """
     Test getting chart of accounts from upstream API
 
     Relies on `requests-mock.Mocker` fixture to inject mock `requests` responses.
     Because requests-mock creates a requests transport adapter, responses are
-    global and not thread-safe. Run two tests sequentially to maintain control
+    global and not thread-safe. Run three tests sequentially to maintain control
     over response order.
     """
 
+    # don't re-use segment IDs from a previous test
+    mocker.patch("mips_api._segment_ids", {})
+
     # inject mock responses into `requests`
     login_mock = requests_mock.post(mips_api._mips_url_login, json=mock_token)
     segment_mock = requests_mock.get(
@@ -365,20 +440,151 @@ def test_upstream(mocker, requests_mock):
 
     # assert all mock urls were called
     assert login_mock.call_count == 1
+    assert login_mock.last_request.json() == {
+        "username": mock_secrets["user"],
+        "password": mock_secrets["pass"],
+        "org": org_name,
+    }
     assert segment_mock.call_count == 1
     assert account_mock.call_count == 1
     assert logout_mock.call_count == 1
 
-    # begin a second test with an alternate requests response
+    # assert the segment ID is re-used on a second run
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == expected_mips_dict_raw
+    assert segment_mock.call_count == 1
+    assert account_mock.call_count == 2
+    assert logout_mock.call_count == 2
+
+    # begin a third test with an alternate requests response
+    mips_api._segment_ids.clear()
 
     # inject new mock response with an Exception
     requests_mock.get(mips_api._mips_url_coa_segments, exc=Exception)
 
     # assert logout is called when an exception is raised
     mips_api._upstream_requests(org_name, mock_secrets)
+    assert logout_mock.call_count == 3
+
+
+def test_upstream_pending_logout(mocker, requests_mock):
+    """Test retrying a failed logout on a run that skips logging in"""
+    mocker.patch("mips_api._segment_ids", {})
+    mocker.patch("mips_api._pending_logouts", [])
+
+    # inject mock responses into `requests`
+    login_mock = requests_mock.post(mips_api._mips_url_login, json=mock_token)
+    requests_mock.get(mips_api._mips_url_coa_segments, json=mock_segments)
+    requests_mock.get(mips_api._mips_url_coa_accounts, json=mock_accounts)
+    logout_mock = requests_mock.post(mips_api._mips_url_logout)
+
+    # assert a failed logout is remembered
+    request_logout = mips_api._request_logout
+    mocker.patch("mips_api._request_logout", side_effect=Exception("logout failed"))
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == expected_mips_dict_raw
+    assert mips_api._pending_logouts == [mock_token["AccessToken"]]
+
+    # assert no login is attempted while the logout still fails
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == {}
+    assert login_mock.call_count == 1
+    assert mips_api._pending_logouts == [mock_token["AccessToken"]]
+
+    # assert login is still skipped on the run that retries the logout
+    mocker.patch("mips_api._request_logout", request_logout)
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == {}
+    assert mips_api._pending_logouts == []
+    assert login_mock.call_count == 1
+    assert logout_mock.call_count == 1
+
+    # assert the next run logs in again
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == expected_mips_dict_raw
+    assert login_mock.call_count == 2
     assert logout_mock.call_count == 2
 
 
+def test_upstream_pending_logout_deadline(mocker, requests_mock):
+    """Test a logout retry that runs out of time keeps the token queued"""
+    mocker.patch("mips_api._upstream_time_limit", 0)
+    mocker.patch("mips_api._pending_logouts", [mock_token["AccessToken"]])
+
+    # inject mock responses into `requests`
+    login_mock = requests_mock.post(mips_api._mips_url_login, json=mock_token)
+    logout_mock = requests_mock.post(mips_api._mips_url_logout)
+
+    # assert no request is sent and the token is retried on a later run
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == {}
+    assert logout_mock.call_count == 0
+    assert login_mock.call_count == 0
+    assert mips_api._pending_logouts == [mock_token["AccessToken"]]
+
+
+def test_upstream_stale_segment(mocker, requests_mock):
+    """Test refreshing a previous segment ID that no longer has accounts"""
+    stale_segid = expected_segid + 1
+    mocker.patch("mips_api._segment_ids", {org_name: (stale_segid, time.monotonic())})
+
+    # inject mock responses into `requests`
+    requests_mock.post(mips_api._mips_url_login, json=mock_token)
+    segment_mock = requests_mock.get(
+        mips_api._mips_url_coa_segments, json=mock_segments
+    )
+    requests_mock.get(mips_api._mips_url_coa_accounts, json=mock_accounts)
+    requests_mock.post(mips_api._mips_url_logout)
+
+    # assert the segment ID is requested again and updated
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == expected_mips_dict_raw
+    assert segment_mock.call_count == 1
+    assert mips_api._segment_ids[org_name][0] == expected_segid
+
+
+def test_request_max_time(mocker):
+    """Test limiting request retries to the shared deadline"""
+    max_time = mips_api._request_max_time(11, 4, "request")
+
+    mocker.patch("mips_api._deadlines", {})
+    assert max_time() == 11
+
+    mocker.patch("mips_api._deadlines", {"request": time.monotonic() + 60})
+    assert max_time() == 11
+
+    # assert time is left for connecting and reading in the last attempt
+    mocker.patch("mips_api._deadlines", {"request": time.monotonic() + 13})
+    assert 4 < max_time() <= 5
+
+    mocker.patch("mips_api._deadlines", {"request": time.monotonic() + 2})
+    assert max_time() == 0
+
+
+def test_check_deadline(mocker):
+    """Test not starting request attempts that can't finish in time"""
+    mocker.patch("mips_api._deadlines", {"logout": time.monotonic() + 13})
+
+    # assert an attempt may take twice its timeout
+    mips_api._check_deadline("logout", 6)
+    with pytest.raises(TimeoutError):
+        mips_api._check_deadline("logout", 7)
+
+    # assert attempts are not limited without a deadline
+    mips_api._check_deadline("request", 60)
+
+
+def test_upstream_deadline(mocker, requests_mock):
+    """Test no upstream request is sent after its deadline"""
+    mocker.patch("mips_api._upstream_time_limit", 0)
+    mocker.patch("mips_api._pending_logouts", [])
+    login_mock = requests_mock.post(mips_api._mips_url_login, json=mock_token)
+
+    mips_dict = mips_api._upstream_requests(org_name, mock_secrets)
+    assert mips_dict == {}
+    assert login_mock.call_count == 0
+
+
 def test_cache_read(mocker):
     """Test reading from S3 cache object"""
     # stub s3 client
@@ -391,6 +597,66 @@ def test_cache_read(mocker):
         assert found == expected_mips_dict_raw
 
 
+def test_cache_read_gzip(mocker):
+    """Test reading from a compressed S3 cache object"""
+    mocker.patch("mips_api._s3_cache_objects", {})
+
+    # stub s3 client
+    mocker.patch.dict(os.environ, {"AWS_DEFAULT_REGION": "test"})
+    s3 = boto3.client("s3")
+    mips_api.s3_client = s3
+    with Stubber(s3) as _stub:
+        body = gzip.compress(json.dumps(expected_mips_dict_raw).encode())
+        _stub.add_response(
+            "get_object", {"Body": io.BytesIO(body), "ContentEncoding": "gzip"}
+        )
+        found = mips_api._s3_cache_read(s3_bucket, s3_path)
+        assert found == expected_mips_dict_raw
+
+
+def test_cache_read_not_modified(mocker):
+    """Test re-using an unchanged S3 cache object"""
+    mocker.patch("mips_api._s3_cache_objects", {})
+
+    # stub s3 client
+    mocker.patch.dict(os.environ, {"AWS_DEFAULT_REGION": "test"})
+    s3 = boto3.client("s3")
+    mips_api.s3_client = s3
+    with Stubber(s3) as _stub:
+        body = io.BytesIO(json.dumps(expected_mips_dict_raw).encode())
+        _stub.add_response(
+            "get_object",
+            {"Body": body, "ETag": '"abc"'},
+            {"Bucket": s3_bucket, "Key": s3_path},
+        )
+        _stub.add_client_error(
+            "get_object",
+            service_error_code="304",
+            http_status_code=304,
+            expected_params={
+                "Bucket": s3_bucket,
+                "Key": s3_path,
+                "IfNoneMatch": '"abc"',
+            },
+        )
+
+        # assert the second read is conditional and returns the known content
+        assert mips_api._s3_cache_read(s3_bucket, s3_path) == expected_mips_dict_raw
+        assert mips_api._s3_cache_read(s3_bucket, s3_path) == expected_mips_dict_raw
+        _stub.assert_no_pending_responses()
+
+
+def test_cache_digest(mocker):
+    """Test reading the digest of the S3 cache object"""
+    # stub s3 client
+    mocker.patch.dict(os.environ, {"AWS_DEFAULT_REGION": "test"})
+    s3 = boto3.client("s3")
+    mips_api.s3_client = s3
+    with Stubber(s3) as _stub:
+        _stub.add_response("head_object", {"Metadata": {"sha256": "abc"}})
+        assert mips_api._s3_cache_digest(s3_bucket, s3_path) == "abc"
+
+
 def test_cache_write(mocker):
     """Test writing to S3 cache object"""
     # stub s3 client
@@ -401,24 +667,46 @@ def test_cache_write(mocker):
         _stub.add_response("put_object", mock_s3_put_response)
 
         # assert no exception is raised
-        mips_api._s3_cache_write(expected_mips_dict_raw, s3_bucket, s3_path)
+        body, digest = mips_api._s3_cache_body(expected_mips_dict_raw)
+        mips_api._s3_cache_write(
+            expected_mips_dict_raw, body, digest, s3_bucket, s3_path
+        )
+
+
+def test_cache_body_order():
+    """Test the S3 cache digest doesn't depend on key order"""
+    reordered = dict(reversed(expected_mips_dict_raw.items()))
+    assert list(reordered) != list(expected_mips_dict_raw)
+
+    body, digest = mips_api._s3_cache_body(expected_mips_dict_raw)
+    assert mips_api._s3_cache_body(reordered) == (body, digest)
 
 
 @pytest.mark.parametrize(
-    "upstream_response,cache_response",
+    "upstream_response,cache_response,expected_write",
     [
-        (expected_mips_dict_raw, None),
-        (None, expected_mips_dict_raw),
-        (expected_mips_dict_raw, expected_mips_dict_raw),
+        (expected_mips_dict_raw, None, True),
+        (None, expected_mips_dict_raw, False),
+        (expected_mips_dict_raw, expected_mips_dict_raw, False),
+        (expected_mips_dict_raw, expected_mips_dict_raw_limit, True),
     ],
 )
-def test_chart(mocker, upstream_response, cache_response):
-    """Test chart_cache() with no upstream response"""
+def test_chart(mocker, upstream_response, cache_response, expected_write):
+    """Test chart_cache() with upstream and cached responses"""
+    cache_digest = None
+    if cache_response is not None:
+        _body, cache_digest = mips_api._s3_cache_body(cache_response)
+
     mocker.patch(
         "mips_api._upstream_requests",
         autospec=True,
         return_value=upstream_response,
     )
+    mocker.patch(
+        "mips_api._s3_cache_digest",
+        autospec=True,
+        return_value=cache_digest,
+    )
     mocker.patch(
         "mips_api._s3_cache_read",
         autospec=True,
@@ -431,6 +719,7 @@ def test_chart(mocker, upstream_response, cache_response):
 
     found_dict = mips_api.chart_cache(org_name, mock_secrets, s3_bucket, s3_path)
     assert found_dict == expected_mips_dict_raw
+    assert write_mock.called == expected_write
 
 
 def test_chart_invalid(mocker):
@@ -451,6 +740,32 @@ def test_chart_invalid(mocker):
         found_dict = mips_api.chart_cache(org_name, mock_secrets, s3_bucket, s3_path)
 
 
+def test_chart_memory_cache(mocker):
+    """Test re-using the chart of accounts on warm runs"""
+    mocker.patch("mips_api._charts", {})
+    mocker.patch("mips_api._get_secrets", autospec=True, return_value=mock_secrets)
+    chart_mock = mocker.patch(
+        "mips_api.chart_cache", autospec=True, return_value=expected_mips_dict_raw
+    )
+    config = {
+        "mips_org": org_name,
+        "ssm_path": ssm_path,
+        "s3_bucket": s3_bucket,
+        "s3_path": s3_path,
+        "chart_ttl": 300,
+    }
+
+    # assert the chart is only collected once
+    assert mips_api._get_chart(config) == expected_mips_dict_raw
+    assert mips_api._get_chart(config) == expected_mips_dict_raw
+    assert chart_mock.call_count == 1
+
+    # assert an expired chart is collected again
+    config["chart_ttl"] = 0
+    assert mips_api._get_chart(config) == expected_mips_dict_raw
+    assert chart_mock.call_count == 2
+
+
 @pytest.mark.parametrize(
     "code_str,code_list",
     [
@@ -479,6 +794,10 @@ def test_parse_codes(code_str, code_list):
             mock_priority_param | mock_inactive_param,
             expected_mips_dict_processed_priority_codes,
         ),
+        (
+            mock_priority_multi_param | mock_inactive_param,
+            expected_mips_dict_processed_priority_codes_multi,
+        ),
         (
             mock_other_param | mock_no_program_param,
             expected_mips_dict_processed_other_no,
@@ -492,6 +811,63 @@ def test_process_chart(params, expected_dict):
     assert json.dumps(processed_chart) == json.dumps(expected_dict)
 
 
+def test_process_chart_cache(mocker):
+    """Test re-using a processed chart of accounts on warm runs"""
+    mocker.patch("mips_api._processed_charts", OrderedDict())
+    mocker.patch("mips_api._processed_source", None)
+    process_spy = mocker.spy(mips_api, "_process_chart")
+
+    args = (expected_omit_codes, other_code, no_program_code)
+
+    # assert the chart is only processed once for the same input
+    first = mips_api.process_chart({}, expected_mips_dict_raw, *args)
+    second = mips_api.process_chart(mock_foo_param, expected_mips_dict_raw, *args)
+    assert first == second == expected_mips_dict_processed
+    assert process_spy.call_count == 1
+
+    # assert the chart is processed again with different options
+    mips_api.process_chart(mock_other_param, expected_mips_dict_raw, *args)
+    assert process_spy.call_count == 2
+
+    # assert the cache is discarded when the chart changes
+    mips_api.process_chart({}, expected_mips_dict_raw_limit, *args)
+    assert process_spy.call_count == 3
+    assert len(mips_api._processed_charts) == 1
+
+    # assert a newly collected chart is processed again, without comparing
+    # its content to the previous chart
+    mips_api.process_chart({}, dict(expected_mips_dict_raw_limit), *args)
+    assert process_spy.call_count == 4
+
+
+def test_process_chart_cache_limit(mocker):
+    """Test limiting the number of processed charts kept on warm runs"""
+    mocker.patch("mips_api._processed_charts", OrderedDict())
+    mocker.patch("mips_api._processed_charts_max", 2)
+    process_spy = mocker.spy(mips_api, "_process_chart")
+
+    args = (expected_omit_codes, other_code, no_program_code)
+    first = {"priority_codes": "123456"}
+    second = {"priority_codes": "234567"}
+    third = {"priority_codes": "999900"}
+
+    # assert the least recently used chart is discarded
+    mips_api.process_chart(first, expected_mips_dict_raw, *args)
+    mips_api.process_chart(second, expected_mips_dict_raw, *args)
+    mips_api.process_chart(first, expected_mips_dict_raw, *args)
+    mips_api.process_chart(third, expected_mips_dict_raw, *args)
+    assert len(mips_api._processed_charts) == 2
+    assert process_spy.call_count == 3
+
+    # assert the recently used chart was kept
+    mips_api.process_chart(first, expected_mips_dict_raw, *args)
+    assert process_spy.call_count == 3
+
+    # assert the discarded chart is processed again
+    mips_api.process_chart(second, expected_mips_dict_raw, *args)
+    assert process_spy.call_count == 4
+
+
 @pytest.mark.parametrize(
     "params,expected_bool",
     [
@@ -510,6 +886,22 @@ def test_param_bool(params, expected_bool):
     assert found_filter_bool == expected_bool
 
 
+def test_query_options():
+    """Test parsing query-string parameters into output options"""
+    params = mock_limit_param | mock_priority_param | mock_no_program_param
+    options = mips_api._query_options(params)
+    assert options.hide_inactive == True
+    assert options.show_other == False
+    assert options.show_no_program == False
+    assert options.priority_codes == ("54321",)
+    assert options.limit == 2
+
+    # assert parsed options are re-used and read-only
+    assert mips_api._query_options(dict(params)) is options
+    with pytest.raises(AttributeError):
+        options.limit = 0
+
+
 @pytest.mark.parametrize(
     "params,expected_int",
     [
@@ -570,8 +962,9 @@ def test_tags(params, expected_list):
     assert tag_list == expected_list
 
 
-def test_lambda_handler_no_env(invalid_event):
+def test_lambda_handler_no_env(invalid_event, mocker):
     """Test lambda handler with no environment variables set"""
+    mocker.patch("mips_api._config", None)
     ret = mips_api.lambda_handler(invalid_event, None)
     json_body = json.loads(ret["body"])
     assert json_body["error"].startswith("The environment variable") == True
@@ -592,14 +985,20 @@ def _test_with_env(mocker, event, code, body=None, error=None):
         "OtherCode": other_code,
         "CacheBucket": s3_bucket,
         "CacheBucketPath": s3_path,
+        "ChartCacheSeconds": "300.5",
     }
     mocker.patch.dict(os.environ, env_vars)
 
+    # don't re-use configuration, secrets, or charts from a previous test
+    mocker.patch("mips_api._config", None)
+    mocker.patch("mips_api._secrets", None)
+    mocker.patch("mips_api._charts", {})
+
     # mock out collect_secrets() with mock secrets
     mocker.patch("mips_api.collect_secrets", autospec=True, return_value=mock_secrets)
 
     # mock out chart_cache() with mock chart
-    mocker.patch(
+    chart_mock = mocker.patch(
         "mips_api.chart_cache", autospec=True, return_value=expected_mips_dict_raw
     )
 
@@ -615,6 +1014,9 @@ def _test_with_env(mocker, event, code, body=None, error=None):
 
     assert ret["statusCode"] == code
 
+    # assert the chart of accounts is only collected for valid routes
+    assert chart_mock.called == (code == 200)
+
 
 def test_lambda_handler_invalid_path(invalid_event, mocker):
     """Test event with no path"""